@@ -1,78 +1,339 @@
 import json
+import orjson
+import msgpack
+import zstandard as zstd
 import base64
 import boto3
+import hashlib
 import os
 import re
-from datetime import datetime, timezone
+import time
+from collections import deque
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.client('s3')
-BUCKET_NAME = "kenya-suzuki-test-bucket"
+# モジュールスコープで生成し、ウォームスタート間でTLS接続プールを再利用する
+# tcp_keepaliveによりアイドル時の接続切断（再ハンドシェイク）を防ぐ
+s3 = boto3.client('s3', config=Config(
+    tcp_keepalive=True,
+    max_pool_connections=10,
+    connect_timeout=1,
+    read_timeout=3,
+    retries={'max_attempts': 2, 'mode': 'adaptive'},
+    s3={'addressing_style': 'virtual'},
+))
+BUCKET_NAME = os.environ.get("BUCKET_NAME", "kenya-suzuki-test-bucket")
 
-def _get_cors_headers():
-    """CORSヘッダーを返す"""
-    return {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "OPTIONS,POST",
-        "Access-Control-Allow-Headers": "Content-Type"
-    }
+# Firehose配信ストリームが設定されている場合はS3のread-modify-writeを行わず、
+# PutRecordBatch一発で済ませる（バッチングとS3への書き出しはFirehose側が行う）
+FIREHOSE_STREAM = os.environ.get("FIREHOSE_STREAM")
+firehose = boto3.client('firehose', config=Config(
+    tcp_keepalive=True,
+    connect_timeout=1,
+    read_timeout=3,
+    retries={'max_attempts': 2, 'mode': 'adaptive'},
+)) if FIREHOSE_STREAM else None
+
+# PutRecordBatchの1回あたりのレコード数上限
+_FIREHOSE_BATCH_MAX = 500
+
+# DynamoDBテーブルが設定されている場合、ユーザーごとのログをUpdateItem一発で
+# アトミックに追記する（GET+PUTの2往復と複数ライターの競合が消える）
+LOGS_TABLE = os.environ.get("LOGS_TABLE")
+ddb = boto3.client('dynamodb', config=Config(
+    tcp_keepalive=True,
+    connect_timeout=1,
+    read_timeout=3,
+    retries={'max_attempts': 2, 'mode': 'adaptive'},
+)) if LOGS_TABLE else None
+
+# S3 Express One Zone（ディレクトリバケット）の場合はAppendObjectによる追記書き込みを使う
+# バケット名は "<name>--<az-id>--x-s3" 形式になる
+_IS_DIRECTORY_BUCKET = BUCKET_NAME.endswith("--x-s3")
+
+# ログの最大保持件数
+MAX_LEN = 10000
+
+# 受け付けるリクエストボディの最大サイズ（デコード・パース前に検査する）
+MAX_BODY_BYTES = 256 * 1024
+
+# 1リクエストで受け付けるイベントの最大件数（正規化ループの上限）
+MAX_EVENTS_PER_REQUEST = 1000
+
+# コンパクション時に末尾から読み込むバイト数（MAX_LEN件を十分含む想定）
+_COMPACT_TAIL_BYTES = 8 * 1024 * 1024
+
+# デバッグログの有効化フラグ（文字列生成・CloudWatch書き込みのコストを避けるため通常は無効）
+DEBUG = os.environ.get("LOG_DEBUG") == "1"
+
+# ウォームスタート間で直近に書き込んだログを保持するキャッシュ
+# ETagが一致すれば（＝他のライターがキーを更新していなければ）GetObjectを省略できる
+_CACHE = {"key": None, "etag": None, "logs": None}
+
+# ログはキーの繰り返しが多く圧縮がよく効くため、zstdで圧縮してからPUTする
+# コンプレッサはモジュールスコープで再利用する（ウォームスタート間で初期化を省略）
+_ZSTD_C = zstd.ZstdCompressor(level=3)
+_ZSTD_D = zstd.ZstdDecompressor()
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# S3への書き込みを複数呼び出し分まとめるバッファ（キーごとの未保存イベント）
+# コンテナ終了時に未フラッシュ分が失われる可能性があるが、運用ログでは許容するトレードオフ
+_BUFFER = {}
+_LAST_FLUSH = [0.0]
+_FLUSH_MAX_EVENTS = 100   # バッファ件数がこれを超えたらフラッシュ
+_FLUSH_MAX_AGE_SEC = 5.0  # 前回フラッシュからの経過秒数がこれを超えたらフラッシュ
+
+# 毎回同一内容のdictを生成しないよう、レスポンス関連はモジュールスコープの定数にする
+# （Lambdaは返却時にシリアライズするだけでレスポンスdictを変更しないため共有してよい）
+_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "OPTIONS,POST",
+    "Access-Control-Allow-Headers": "Content-Type"
+}
+_OPTIONS_RESPONSE = {"statusCode": 204, "headers": _CORS_HEADERS, "body": ""}
+_SUCCESS_RESPONSE = {"statusCode": 204, "headers": _CORS_HEADERS, "body": ""}
+_NOT_WEB_RESPONSE = {"statusCode": 200, "headers": _CORS_HEADERS, "body": "Not a web request"}
+_TOO_LARGE_RESPONSE = {"statusCode": 413, "headers": _CORS_HEADERS, "body": ""}
+
+# ホットパスで毎回re内部のキャッシュを引かないよう、モジュールロード時にコンパイルしておく
+_BAD_CHARS_RE = re.compile(r'[<>:"/\\|?*\s]')  # 危険な文字とスペース
+_MULTI_US_RE = re.compile(r'_+')  # 連続するアンダースコア
 
 def _sanitize_username(username):
     """ユーザー名をサニタイズしてファイル名に使用可能にする"""
     if not username or not isinstance(username, str):
         return "anonymous"
-    
-    # 危険な文字とスペースを除去または置換
-    sanitized = re.sub(r'[<>:"/\\|?*\s]', '_', username)
-    # 連続するアンダースコアを単一に
-    sanitized = re.sub(r'_+', '_', sanitized)
-    # 先頭・末尾のアンダースコアを除去
-    sanitized = sanitized.strip('_')
+    # 危険な文字を'_'に置換→連続する'_'を単一化→先頭・末尾の'_'を除去
+    sanitized = _MULTI_US_RE.sub('_', _BAD_CHARS_RE.sub('_', username)).strip('_')
     # 空文字列の場合はanonymousに
-    if not sanitized:
-        return "anonymous"
-    
-    return sanitized
+    return sanitized or "anonymous"
+
+def _key_for(sanitized_username: str, ext: str = ".json"):
+    """ユーザー名からS3キーを生成する。
+
+    ハッシュ由来の2桁プレフィックスを挟むことでキーが256プレフィックスに分散し、
+    logs/直下が単一のホットパーティションになるのを避ける。
+    決定的なので読み込み側も同じキーに到達する。
+    """
+    h = hashlib.md5(sanitized_username.encode()).hexdigest()[:2]
+    return f"logs/{h}/{sanitized_username}{ext}"
 
 def _load_existing_logs(key: str):
-    """S3から既存のログを読み込む。ファイルが存在しない場合は空の配列を返す"""
+    """S3から既存のログを読み込む。ファイルが存在しない場合は空の配列を返す
+
+    本体はMessagePackのイベント列としてストリームパースし、末尾MAX_LEN件のみを
+    リングバッファに保持する。ファイル全体のbytesと全要素のリストを同時にメモリに
+    置かないため、ピークメモリはファイルサイズではなく保持件数に比例する。
+    旧形式（JSON配列）のファイルも読み込めるが、次回の保存でMessagePackに移行される。
+    """
     try:
-        # print(f"DEBUG: Attempting to load from S3: bucket='{BUCKET_NAME}', key='{key}'")
-        obj = s3.get_object(Bucket=BUCKET_NAME, Key=key)
-        data = obj["Body"].read()
-        if not data:
-            # print("DEBUG: Empty file, returning empty list")
+        # このコンテナが最後のライターであればHEADだけで済ませ、本体転送とパースを省略する
+        if _CACHE["key"] == key and _CACHE["etag"] is not None:
+            head = s3.head_object(Bucket=BUCKET_NAME, Key=key)
+            if head["ETag"] == _CACHE["etag"]:
+                return _CACHE["logs"]
+        body = s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"]
+        first = body.read(4)
+        if not first:
             return []
-        parsed = json.loads(data)
-        if isinstance(parsed, list):
-            # print(f"DEBUG: Successfully loaded {len(parsed)} logs from existing file")
-            return parsed
-        # print("DEBUG: File exists but is not a list, returning empty list")
-        return []
+        buf = deque(maxlen=MAX_LEN)
+        if first[:1] == b'[':
+            # 旧形式（JSON配列）: 移行用のフォールバック
+            try:
+                parsed = orjson.loads(first + body.read())
+            except orjson.JSONDecodeError:
+                return []
+            if not isinstance(parsed, list):
+                return []
+            buf.extend(parsed)
+        else:
+            # zstd圧縮されている場合はチャンクごとに伸長しながらアンパックする
+            dobj = _ZSTD_D.decompressobj() if first == _ZSTD_MAGIC else None
+            unpacker = msgpack.Unpacker(raw=False)
+            try:
+                # 判定に使った先頭4バイトも忘れずにfeedする
+                unpacker.feed(dobj.decompress(first) if dobj else first)
+                for item in unpacker:
+                    # ほぼ任意のバイト列が有効なmsgpackとして解釈できてしまうため、
+                    # イベント（dict）以外が出てきたら壊れたファイルとみなして空を返す
+                    if not isinstance(item, dict):
+                        return []
+                    buf.append(item)
+                for chunk in iter(lambda: body.read(65536), b""):
+                    unpacker.feed(dobj.decompress(chunk) if dobj else chunk)
+                    for item in unpacker:
+                        if not isinstance(item, dict):
+                            return []
+                        buf.append(item)
+            except (msgpack.UnpackException, zstd.ZstdError):
+                return []
+        if DEBUG:
+            print(f"DEBUG: Successfully loaded {len(buf)} logs from existing file")
+        return list(buf)
     except ClientError as e:
         error_code = e.response.get('Error', {}).get('Code')
-        # print(f"DEBUG: S3 ClientError: {error_code}")
         if error_code in ("NoSuchKey", "404"):
             # ファイルが存在しない場合は空の配列を返す（自動作成の準備）
-            # print("DEBUG: File does not exist, returning empty list for auto-creation")
             return []
-        # print(f"ERROR: Unexpected S3 error: {str(e)}")
+        if DEBUG:
+            print(f"ERROR: Unexpected S3 error: {str(e)}")
         raise
 
 def _save_logs(key: str, logs: list):
     """S3にログを保存する。ファイルが存在しない場合は自動作成される"""
     try:
-        # print(f"DEBUG: Attempting to save to S3: bucket='{BUCKET_NAME}', key='{key}', logs_count={len(logs)}")
         response = s3.put_object(
             Bucket=BUCKET_NAME,
             Key=key,
-            Body=json.dumps(logs, ensure_ascii=False),
-            ContentType='application/json'
+            # イベントごとにパックした列をzstdで圧縮して保存する
+            # （読み込み側でチャンク伸長しながらストリームパース可能）
+            Body=_ZSTD_C.compress(b"".join(msgpack.packb(ev, use_bin_type=True) for ev in logs)),
+            ContentType='application/vnd.msgpack',
+            ContentEncoding='zstd'
         )
-        # print(f"DEBUG: S3 put_object successful: ETag={response.get('ETag', 'N/A')}")
+        # 書き込んだ内容をキャッシュし、次回のGetObject + パースを省略できるようにする
+        _CACHE["key"] = key
+        _CACHE["etag"] = response.get("ETag")
+        _CACHE["logs"] = logs
+        if DEBUG:
+            print(f"DEBUG: S3 put_object successful: ETag={response.get('ETag', 'N/A')}")
     except Exception as e:
-        # print(f"ERROR: Failed to save logs to S3: {str(e)}")
+        if DEBUG:
+            print(f"ERROR: Failed to save logs to S3: {str(e)}")
+        raise
+
+def _append_logs_ndjson(key: str, events: list):
+    """S3 Express One ZoneのAppendObjectで新規イベントのみをNDJSONとして追記する。
+
+    既存ログのGET・再シリアライズを行わず、現在サイズの取得（HeadObject）と
+    新規分のPUTだけで完了するため、書き込みコストはログ全体のサイズに依存しない。
+    上限件数（MAX_LEN）のトリムは定期的なコンパクションLambdaに任せる。
+    """
+    try:
+        offset = s3.head_object(Bucket=BUCKET_NAME, Key=key)["ContentLength"]
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code not in ("NoSuchKey", "404"):
+            raise
+        # ファイルが存在しない場合は先頭から書き込む（自動作成）
+        offset = 0
+    body = b"".join(orjson.dumps(ev) + b"\n" for ev in events)
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        Body=body,
+        WriteOffsetBytes=offset,
+        ContentType='application/x-ndjson'
+    )
+
+def _utc_now_iso():
+    """現在時刻をISO 8601形式（UTC）で返す。
+
+    datetime.now(timezone.utc).isoformat()と同じ形式だが、datetimeオブジェクトの
+    生成を省略するためホットパスでのアロケーションが少ない。
+    """
+    t = time.time()
+    sec = int(t)
+    us = int((t - sec) * 1_000_000)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)) + f".{us:06d}+00:00"
+
+def _append_events_dynamodb(sanitized_username: str, events: list):
+    """DynamoDBのユーザー項目にイベントをアトミックに追記する。
+
+    list_appendによる単一往復の追記なので、既存ログの読み込み・再シリアライズが
+    不要で、複数の同時ライターがあっても更新が失われない。MAX_LENを超えた項目の
+    S3へのアーカイブは定期ジョブに任せる。
+    """
+    ddb.update_item(
+        TableName=LOGS_TABLE,
+        Key={'user': {'S': sanitized_username}},
+        UpdateExpression='SET events = list_append(if_not_exists(events, :e), :new)',
+        ExpressionAttributeValues={
+            ':new': {'L': [{'S': orjson.dumps(ev).decode()} for ev in events]},
+            ':e': {'L': []},
+        },
+    )
+
+def _maybe_flush(force: bool = False):
+    """バッファしたイベントを閾値超過時（または強制時）にまとめてS3へ書き出す。
+
+    read-modify-writeのコストを複数呼び出しに分散させるため、呼び出しごとではなく
+    件数・経過時間の閾値を超えたときだけフラッシュする。
+    """
+    if not _BUFFER:
+        return
+    total = sum(len(evs) for evs in _BUFFER.values())
+    if not (force or total >= _FLUSH_MAX_EVENTS
+            or time.time() - _LAST_FLUSH[0] > _FLUSH_MAX_AGE_SEC):
+        return
+    for key in list(_BUFFER):
+        events = _BUFFER[key]
+        # maxlen付きdequeなら追記時に古い要素がO(1)で押し出されるため、
+        # 2倍サイズの中間リストやスライスによるトリムが不要
+        buf = deque(_load_existing_logs(key), maxlen=MAX_LEN)
+        buf.extend(events)
+        _save_logs(key, list(buf))
+        # 保存に成功したキーは即座にバッファから外す
+        # （後続キーの保存が失敗しても、書き込み済みイベントを再追記しない）
+        del _BUFFER[key]
+        if DEBUG:
+            print(f"DEBUG: Flushed {len(events)} buffered events to key='{key}'")
+    _LAST_FLUSH[0] = time.time()
+
+def _put_events_firehose(events: list):
+    """FirehoseへイベントをNDJSONレコードとして送信する。
+
+    Firehoseがサーバ側でレコードを連結・バッファリングしてS3へ書き出すため、
+    Lambda側のコストはPutRecordBatchの往復のみでログ全体のサイズに依存しない。
+    """
+    for i in range(0, len(events), _FIREHOSE_BATCH_MAX):
+        firehose.put_record_batch(
+            DeliveryStreamName=FIREHOSE_STREAM,
+            Records=[{'Data': orjson.dumps(ev) + b"\n"}
+                     for ev in events[i:i + _FIREHOSE_BATCH_MAX]],
+        )
+
+def compact_ndjson_log(key: str):
+    """NDJSONログを末尾MAX_LEN行にトリムする。
+
+    Range GETでファイル末尾のみを取得するため、読み込み量はログ全体の
+    サイズによらず_COMPACT_TAIL_BYTESで頭打ちになる。
+    """
+    try:
+        head = s3.head_object(Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code in ("NoSuchKey", "404"):
+            return
         raise
+    size = head["ContentLength"]
+    start = max(0, size - _COMPACT_TAIL_BYTES)
+    obj = s3.get_object(Bucket=BUCKET_NAME, Key=key, Range=f"bytes={start}-")
+    data = obj["Body"].read()
+    lines = data.split(b"\n")
+    if start > 0:
+        # 途中から読んだ場合、先頭は行の断片なので捨てる
+        lines = lines[1:]
+    kept = [ln for ln in lines if ln]
+    if start == 0 and len(kept) <= MAX_LEN:
+        # 全体を読み切っていてトリム不要ならPUTを省略
+        return
+    lines = kept[-MAX_LEN:]
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        Body=b"\n".join(lines) + b"\n" if lines else b"",
+        ContentType='application/x-ndjson'
+    )
+
+def compact_handler(event, context):
+    """定期実行用のエントリポイント: logs/配下のNDJSONログをすべてトリムする"""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix="logs/"):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".jsonl"):
+                compact_ndjson_log(obj["Key"])
+    return {"statusCode": 200}
 
 def lambda_handler(event, context):
     """
@@ -86,49 +347,44 @@ def lambda_handler(event, context):
         dict: HTTPレスポンス
     """
     
-    # CORSプリフライトリクエスト（OPTIONS）の処理
-    if event.get("httpMethod") == "OPTIONS":
-        return {"statusCode": 204, "headers": _get_cors_headers(), "body": ""}
-    
-    if event.get("requestContext", {}).get("http", {}).get("method") == "OPTIONS":
-        return {"statusCode": 204, "headers": _get_cors_headers(), "body": ""}
+    # ボディ解析より前に、CORSプリフライト（OPTIONS）とS3イベントを即座に返す
+    # （ブラウザ経由のワークロードではプリフライトがPOSTより多くなることがある）
+    # .get(..., {})のデフォルトは毎回空dictを生成するため、None許容で辿る
+    http_ctx = event.get("requestContext")
+    http_ctx = http_ctx.get("http") if http_ctx else None
+    method = event.get("httpMethod") or (http_ctx.get("method") if http_ctx else None)
+    if method == "OPTIONS":
+        return _OPTIONS_RESPONSE
+    if "Records" in event:  # S3イベントなど
+        return _NOT_WEB_RESPONSE
 
-    # リクエストボディの取得
-    raw = None
-    
-    # API Gateway v1 (REST API) の場合
-    if "body" in event:
-        raw = event["body"]
-    # API Gateway v2 (HTTP API) の場合
-    elif "requestContext" in event and "http" in event.get("requestContext", {}):
-        if "body" in event:
-            raw = event["body"]
-        else:
-            # プリフライトリクエストやGETリクエストの場合
-            return {"statusCode": 204, "headers": _get_cors_headers(), "body": ""}
-    elif "Records" in event:  # S3イベントなど
-        return {"statusCode": 200, "headers": _get_cors_headers(), "body": "Not a web request"}
+    # リクエストボディの取得（v1/v2とも"body"、なければNone）
+    raw = event.get("body")
+    if raw is None:
+        if "requestContext" in event:
+            # ボディのないGETリクエストなどの場合
+            return _SUCCESS_RESPONSE
+        # 直接呼び出しの場合はeventがそのままペイロード（JSONの往復を省略）
+        payload_obj = event or {}
     else:
-        # 直接呼び出しの場合
-        raw = json.dumps(event) if event else "{}"
-    
-    # リクエストボディの解析
-    try:
-        if raw is None:
-            raw = "{}"
-        
-        # Base64デコード（API Gateway v2の場合）
-        if event.get("isBase64Encoded") and isinstance(raw, str):
-            try:
-                raw = base64.b64decode(raw).decode("utf-8")
-            except Exception:
-                raw = "{}"
-        
-        # JSONパース
-        payload_obj = json.loads(raw) if isinstance(raw, str) else (raw or {})
-        
-    except Exception:
-        payload_obj = {}
+        # 巨大なボディはデコード・パースする前に拒否し、メモリとCPUの上限を保証する
+        if isinstance(raw, (str, bytes)) and len(raw) > MAX_BODY_BYTES:
+            return _TOO_LARGE_RESPONSE
+
+        # リクエストボディの解析
+        try:
+            # Base64デコード（API Gateway v2の場合）
+            if event.get("isBase64Encoded") and isinstance(raw, str):
+                try:
+                    raw = base64.b64decode(raw).decode("utf-8")
+                except Exception:
+                    raw = "{}"
+
+            # JSONパース
+            payload_obj = orjson.loads(raw) if isinstance(raw, (str, bytes)) else (raw or {})
+
+        except Exception:
+            payload_obj = {}
 
     # ユーザー名を抽出してファイル名を決定
     username = "anonymous"  # デフォルト値
@@ -147,10 +403,10 @@ def lambda_handler(event, context):
     
     # ユーザー名をサニタイズしてファイル名を生成
     sanitized_username = _sanitize_username(username)
-    key = f"logs/{sanitized_username}.json"
-    
-    # デバッグログ
-    # print(f"DEBUG: username='{username}', sanitized='{sanitized_username}', key='{key}'")
+    key = _key_for(sanitized_username)
+
+    if DEBUG:
+        print(f"DEBUG: username='{username}', sanitized='{sanitized_username}', key='{key}'")
 
     # イベント配列の抽出
     incoming_events = []
@@ -161,42 +417,54 @@ def lambda_handler(event, context):
     elif isinstance(payload_obj, dict) and payload_obj:
         incoming_events = [payload_obj]
 
+    # 正規化ループの仕事量も件数で頭打ちにする
+    # （保持上限が新しいもの優先のため、超過分は古い先頭側から切り捨てる）
+    if len(incoming_events) > MAX_EVENTS_PER_REQUEST:
+        incoming_events = incoming_events[-MAX_EVENTS_PER_REQUEST:]
+
     # 各イベントにサーバ受信時刻を付与
-    received_at = datetime.now(timezone.utc).isoformat()
-    normalized_events = []
-    for ev in incoming_events:
-        if isinstance(ev, dict):
-            ev = {**ev, "received_at": received_at}
-            normalized_events.append(ev)
+    # payload_objはこの後使わないため、コピーせずにそのまま書き込んでよい
+    received_at = _utc_now_iso()
+    normalized_events = [ev for ev in incoming_events if isinstance(ev, dict)]
+    for ev in normalized_events:
+        ev["received_at"] = received_at
 
     # 既存ログを読み込み、追記し、上限でトリム
     # ファイルが存在しない場合は空の配列から開始（自動作成）
     try:
-        # print(f"DEBUG: Loading existing logs from key='{key}'")
-        existing_logs = _load_existing_logs(key)
-        # print(f"DEBUG: Loaded {len(existing_logs)} existing logs")
-        
-        combined_logs = existing_logs + normalized_events
-        # print(f"DEBUG: Combined logs count: {len(combined_logs)}")
-        
-        # 最大件数を制限（10,000件）
-        MAX_LEN = 10000
-        if len(combined_logs) > MAX_LEN:
-            combined_logs = combined_logs[-MAX_LEN:]
-            # print(f"DEBUG: Trimmed to {len(combined_logs)} logs")
-        
-        # print(f"DEBUG: Saving logs to key='{key}'")
-        _save_logs(key, combined_logs)
-        # print(f"DEBUG: Successfully saved {len(combined_logs)} logs")
-        
+        # Firehoseが設定されている場合は送信のみ（S3の読み書きは配信側に任せる）
+        if FIREHOSE_STREAM:
+            if normalized_events:
+                _put_events_firehose(normalized_events)
+            return _SUCCESS_RESPONSE
+
+        # DynamoDBテーブルが設定されている場合は単一往復のアトミック追記
+        if LOGS_TABLE:
+            if normalized_events:
+                _append_events_dynamodb(sanitized_username, normalized_events)
+            return _SUCCESS_RESPONSE
+
+        # ディレクトリバケットの場合は追記のみ（既存ログの読み書きをスキップ）
+        if _IS_DIRECTORY_BUCKET:
+            if normalized_events:
+                _append_logs_ndjson(_key_for(sanitized_username, ext=".jsonl"), normalized_events)
+            return _SUCCESS_RESPONSE
+
+        # バッファに積み、閾値を超えたときだけS3へまとめて書き出す
+        # 残り実行時間が少ない場合はコンテナ終了に備えて強制フラッシュする
+        if normalized_events:
+            _BUFFER.setdefault(key, []).extend(normalized_events)
+        force = context is not None and context.get_remaining_time_in_millis() < 500
+        _maybe_flush(force)
+
     except Exception as e:
-        # print(f"ERROR: Failed to process logs: {str(e)}")
-        # print(f"ERROR: Key='{key}', Events count={len(normalized_events)}")
+        if DEBUG:
+            print(f"ERROR: Failed to process logs: key='{key}', events={len(normalized_events)}, error={str(e)}")
         return {
             "statusCode": 500,
-            "headers": _get_cors_headers(),
+            "headers": _CORS_HEADERS,
             "body": json.dumps({"message": "Failed to append logs", "error": str(e)})
         }
 
     # 成功時は204 No Contentを返す（サーバ負荷軽減）
-    return {"statusCode": 204, "headers": _get_cors_headers(), "body": ""}
\ No newline at end of file
+    return _SUCCESS_RESPONSE
\ No newline at end of file